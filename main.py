@@ -1,12 +1,16 @@
 import streamlit as st
-import pandas as pd
 from datetime import datetime
 from fillpdf import fillpdfs
 import os
 from pathlib import Path
-import requests
-import base64
+import httpx
+import pybase64
+import orjson
 import io
+import csv
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
 st.set_page_config(
     page_title="KP-Admin",
@@ -16,159 +20,229 @@ st.set_page_config(
 )
 
 # Repository details
-st.session_state.repo_url = st.secrets['forgejo']['repo_url']
-st.session_state.api_base = st.secrets['forgejo']['api_base']
-st.session_state.branch = "main"  # Adjust if the branch is different
-st.session_state.auth = (st.secrets['forgejo']['username'], st.secrets['forgejo']['password'])
-st.session_state.owner = st.secrets['forgejo']['owner']
-st.session_state.repo = st.secrets['forgejo']['repo']
+FORGEJO = st.secrets['forgejo']
+API_BASE = FORGEJO['api_base']
+BRANCH = "main"  # Adjust if the branch is different
+AUTH = (FORGEJO['username'], FORGEJO['password'])
+OWNER = FORGEJO['owner']
+REPO = FORGEJO['repo']
+CONTENTS_BASE = f"{API_BASE}/repos/{OWNER}/{REPO}/contents/"
+JSON_HEADERS = {"Content-Type": "application/json"}
+TIMESTAMP_FORMAT = "%Y-%m-%d-%H-%M"  # Used in commit messages
+
+
+@st.cache_resource
+def get_client(auth):
+    """
+    Builds a pooled keep-alive HTTP client shared across reruns, so requests to Forgejo reuse an
+    open connection instead of paying for a new TCP/TLS handshake each time.
+
+    Parameters:
+        -auth(tuple): The (username, password) pair used for every request
+    Returns:
+        -httpx.Client: The authenticated client
+    """
+    # Pool and HTTP/2 settings belong to the transport once a custom one is given
+    transport = httpx.HTTPTransport(
+        http2=True,
+        retries=3,
+        limits=httpx.Limits(max_connections=8, max_keepalive_connections=4)
+    )
+    return httpx.Client(auth=auth, timeout=30.0, follow_redirects=True, transport=transport)
 
 
-def fetch_records(file_path="assets/form_records.csv", header=0):
+def fetch_file(file_path, missing_ok=False):
     """
-    Function to fetch csv spreadsheets
+    Function to fetch the content of a repository file, along with the SHA of that version
 
     Parameters:
-        -file_path(str): The path to the subfolder (e.g., 'master.csv').
-        -header(int or None): Indicate the index of the csv headers. Default = 0
+        -file_path(str): The path to the file in the repository (e.g., 'assets/form_records.csv').
+        -missing_ok(bool): Return empty content instead of an error if the file doesn't exist. Default = False
     Returns:
-        -pandas.dataframe: The csv file as a Pandas DataFrame
+        -tuple: (content, sha) with the content as bytes; (b"", None) if the file doesn't exist and
+         missing_ok is set; (None, None) if it could not be fetched
     """
-    raw_url = f"{st.session_state.repo_url}/raw/{st.session_state.branch}/{file_path}"
     try:
-        response = requests.get(raw_url, auth=st.session_state.auth)
+        # One contents API call returns both, so the content always matches the SHA sent back on update
+        response = get_client(AUTH).get(CONTENTS_BASE + file_path, params={"ref": BRANCH})
+        if response.status_code == 404 and missing_ok:
+            return b"", None
         if response.status_code == 200:
-            return pd.read_csv(io.StringIO(response.content.decode('utf-8')), header=header)
+            contents = orjson.loads(response.content)
+            return pybase64.b64decode(contents['content']), contents['sha']
         else:
             st.error(f"Failed to fetch {file_path}. Status code: {response.status_code}")
-            return None
+            return None, None
     except Exception as e:
         st.error(f"Error: {e}")
-        return None
+        return None, None
 
 
-def post_to_repo(pdf_path, file_path, name="Researcher", message=None):
+def _append_csv_row(file_path, existing, new_record):
     """
-    The function to post a filled PDF to the repository.
+    Builds the content of a repository CSV file with one more row.
 
     Parameters:
-        - pdf_path (str): The local path to the filled PDF file
-        - file_path (str): The path where the PDF will be posted in the Forgejo repository
-        - name (str): Name of the person submitting the file
-        - message (str): The commit message for the upload
-    Return:
-        - A success message if it goes well or an error message if fails.
+    - file_path (str): The path to the CSV file in the repository, for error messages.
+    - existing (bytes): The current content of the file; empty if it doesn't exist yet.
+    - new_record (dict): The row to append, keyed by column name.
+
+    Returns:
+    - bytes: The existing content followed by the new row, or None if its header doesn't cover the
+      record. A missing or empty file gets a header from the record keys.
     """
-    # Read the PDF file and encode it to base64
-    with open(pdf_path, 'rb') as pdf_file:
-        pdf_content = pdf_file.read()
-        content = base64.b64encode(pdf_content).decode()
-
-    url = f"{st.session_state.api_base}/repos/{st.session_state.owner}/{st.session_state.repo}/contents/{file_path}"
-    if message is None:
-        message = f"PDF uploaded by {name} at {datetime.now().strftime('%Y-%m-%d-%H-%m')}"
-
-    payload = {
-        "message": message,
-        "content": content,
-        "branch": st.session_state.branch
-    }
-    response = requests.post(url, json=payload, auth=st.session_state.auth)
-    if response.status_code in (200, 201):
-        st.success(f"PDF correctly submitted for review: {message}")
-        return True
+    row = io.StringIO()
+    if existing.strip():
+        # Keep the line endings the file already uses (taken from its header line)
+        header_line = existing.split(b"\n", 1)[0]
+        terminator = "\r\n" if header_line.endswith(b"\r") else "\n"
+        # Order the values by the header of the remote file (utf-8-sig drops a leading BOM)
+        columns = next(csv.reader([header_line.decode('utf-8-sig').rstrip("\r")]))
+        unknown = [key for key in new_record if key not in columns]
+        if unknown:
+            st.error(f"{file_path} has no column for {', '.join(unknown)}; its header is {', '.join(columns)}")
+            return None
+        if not existing.endswith(b"\n"):
+            existing += terminator.encode('ascii')
+        writer = csv.writer(row, lineterminator=terminator)
     else:
-        st.error(f"Failed to commit: {response.text}")
-        st.session_state['success'] = False
-        return False
+        columns = list(new_record)
+        writer = csv.writer(row, lineterminator="\n")
+        writer.writerow(columns)
+        existing = b""
+    writer.writerow([new_record.get(column, "") for column in columns])
+    return existing + row.getvalue().encode('utf-8')
 
 
-def update_repo_file(file_path, new_content, name="Researcher", commit_message=None, **to_csv_kwargs):
+def commit_multi(message, updates=None, creates=None, prefetched=None):
     """
-    Updates or creates a CSV file in a Forgejo repository.
+    Commits several files to a Forgejo repository as a single commit, through the
+    multiple-files contents endpoint.
 
     Parameters:
-    - file_path (str): The path to the CSV file in the repository (e.g., 'data/example.csv').
-    - new_content (pd.DataFrame): The new CSV content as a Pandas DataFrame.
-    - commit_message (str): The commit message for the update.
-    - **to_csv_kwargs: Additional keyword arguments to pass to DataFrame.to_csv().
+    - message (str): The commit message.
+    - updates (dict): Maps the path of each file to update to a callable that takes its current content
+      (empty if it doesn't exist yet) and returns the new bytes, or None to abort. The content is fetched
+      along with its SHA right before the commit, and the update is checked against that SHA; if another
+      commit landed in between, the callables are applied again to the newer content and the commit is
+      retried once.
+    - creates (dict): Maps the path of each new file to its content as bytes. These are only ever
+      created: if a file already exists at one of these paths the commit fails instead of overwriting it.
+    - prefetched (dict): Optional (content, sha) results of fetch_file for some of the updated paths,
+      used instead of fetching them again on the first attempt.
 
     Returns:
-    - bool: True if the update was successful, False otherwise.
-
-    Note:
-    - The 'path_or_buf' argument in to_csv_kwargs is ignored, as the function always generates a string.
+    - bool: True if the commit was successful, False otherwise.
     """
-    # Check if new_content is a DataFrame
-    if not isinstance(new_content, pd.DataFrame):
-        st.error("new_content must be a Pandas DataFrame")
-        return False
-
-    # Construct the API URL using session state variables
-    url = f"{st.session_state.api_base}/repos/{st.session_state.owner}/{st.session_state.repo}/contents/{file_path}"
-
-    # Step 1: Try to retrieve the current file info to get the SHA
-    try:
-        response = requests.get(url, auth=st.session_state.auth)
-        if response.status_code == 200:
-            # File exists, extract the SHA
-            contents = response.json()
-            sha = contents['sha']
-        elif response.status_code == 404:
-            # File doesn’t exist, we’ll create it (no SHA needed)
-            sha = None
-        else:
-            # Unexpected status code
-            st.error(f"Error retrieving file info: {response.status_code} - {response.text}")
+    updates = updates or {}
+    prefetched = prefetched or {}
+    created = [
+        {"path": file_path, "content": pybase64.b64encode_as_string(content_bytes), "operation": "create"}
+        for file_path, content_bytes in (creates or {}).items()
+    ]
+
+    sent_shas = None
+    for attempt in range(2):
+        changes = []
+        shas = {}
+        for file_path, build_content in updates.items():
+            if attempt == 0 and file_path in prefetched:
+                existing, sha = prefetched[file_path]
+            else:
+                existing, sha = fetch_file(file_path, missing_ok=True)
+            if existing is None:
+                return False
+            content_bytes = build_content(existing)
+            if content_bytes is None:
+                return False
+            shas[file_path] = sha
+            change = {"path": file_path, "content": pybase64.b64encode_as_string(content_bytes)}
+            if sha:
+                change.update(operation="update", sha=sha)
+            else:
+                change["operation"] = "create"
+            changes.append(change)
+        if shas == sent_shas:
+            # None of the updated files changed, so the conflict came from a file to be created
+            st.error(f"Failed to commit: {response.status_code} - {response.text}")
             return False
-    except requests.RequestException as e:
-        st.error(f"Failed to fetch file info: {e}")
-        return False
 
-    # Step 2: Convert DataFrame to CSV string
-    to_csv_kwargs.pop('path_or_buf', None)  # Ensure path_or_buf is not set
-    csv_string = new_content.to_csv(**to_csv_kwargs, index=False)
-
-    # Step 3: Prepare the new content by encoding it to base64
-    content_bytes = csv_string.encode('utf-8')
-    content_base64 = base64.b64encode(content_bytes).decode('utf-8')
-
-    # Step 4: Build the request body for the PUT request
-    if not commit_message:
-        commit_message = f"Edited by {name} at {datetime.now().strftime('%Y-%m-%d-%H-%m')}"
-    data = {
-        "message": commit_message,
-        "content": content_base64
-    }
-    if sha:
-        data["sha"] = sha  # Include SHA only if updating an existing file
-
-    # Step 5: Send the PUT request to update or create the file
-    try:
-        response = requests.put(url, json=data, auth=st.session_state.auth)
+        payload = {
+            "message": message,
+            "branch": BRANCH,
+            "files": changes + created
+        }
+        try:
+            response = get_client(AUTH).post(CONTENTS_BASE.rstrip("/"), content=orjson.dumps(payload),
+                                             headers=JSON_HEADERS)
+        except httpx.HTTPError as e:
+            st.error(f"Failed to commit: {e}")
+            return False
         if response.status_code in [200, 201]:
-            # 200 for update, 201 for create
-            st.success("File updated successfully.")
+            st.success(f"Files committed successfully: {message}")
             return True
-        else:
-            st.error(f"Failed to update file: {response.status_code} - {response.text}")
-            return False
-    except requests.RequestException as e:
-        st.error(f"Failed to update file: {e}")
+        if response.status_code in [409, 412, 422] and attempt == 0 and updates:
+            # Possibly a SHA mismatch: someone else committed to one of the updated files meanwhile
+            sent_shas = shas
+            continue
+        st.error(f"Failed to commit: {response.status_code} - {response.text}")
         return False
 
 
+def _submission_digest(file_path, form_data):
+    """
+    Hashes the form data together with the PDF destination path, to recognise a repeated submission
+    before any work is done. The filled PDF is fully determined by these.
+
+    Parameters:
+    - file_path (str): The path where the PDF will be posted in the repository.
+    - form_data (dict): The values filled into the form, keyed by field name.
+
+    Returns:
+    - bytes: A 16-byte blake2b digest.
+    """
+    hasher = hashlib.blake2b(file_path.encode('utf-8') + b"\0", digest_size=16)
+    hasher.update(orjson.dumps(form_data, option=orjson.OPT_SORT_KEYS))
+    return hasher.digest()
+
+
+@st.cache_resource
+def _form_fields(pdf_path, mtime):
+    """
+    Lists the fillable field names of a PDF, parsed once per file version.
+
+    Parameters:
+        -pdf_path(str): The local path to the fillable PDF
+        -mtime(float): The modification time of the PDF, used only as part of the cache key
+    Returns:
+        -list: The form field names in document order
+    """
+    return list(fillpdfs.get_form_fields(pdf_path).keys())
+
+
+@st.cache_data(show_spinner=False)
+def _pdf_bytes(pdf_path, mtime):
+    """
+    Reads a PDF from disk, once per file version.
+
+    Parameters:
+        -pdf_path(str): The local path to the PDF
+        -mtime(float): The modification time of the PDF, used only as part of the cache key
+    Returns:
+        -bytes: The raw PDF content
+    """
+    return Path(pdf_path).read_bytes()
+
+
 st.title("Poduska's Lab Administration")
 
-# Ensure assets directory exists
+# Local assets (the blank form ships with the app; nothing is written here)
 ASSETS_DIR = "assets"
-Path(ASSETS_DIR).mkdir(exist_ok=True)
 INPUT_PDF = os.path.join(ASSETS_DIR, "f100d_e_fillable.pdf")
-OUTPUT_PDF = os.path.join(ASSETS_DIR, "filled_form.pdf")
 CSV_FILE = os.path.join(ASSETS_DIR, "form_records.csv")
 
 # Get form fields
-form_fields = list(fillpdfs.get_form_fields(INPUT_PDF).keys())
+form_fields = _form_fields(INPUT_PDF, os.path.getmtime(INPUT_PDF))
 
 # Initialize session state
 if "f100d_e" not in st.session_state:
@@ -177,16 +251,16 @@ if "f100d_e" not in st.session_state:
 
 # Option 1: Download blank PDF
 st.subheader("Download Blank Form")
-with open(INPUT_PDF, "rb") as file:
-    st.download_button(
-        label="Download Blank PDF",
-        data=file,
-        file_name="f100d_e_fillable.pdf",
-        mime="application/pdf"
-    )
+st.download_button(
+    label="Download Blank PDF",
+    data=_pdf_bytes(INPUT_PDF, os.path.getmtime(INPUT_PDF)),
+    file_name="f100d_e_fillable.pdf",
+    mime="application/pdf"
+)
 
 # Option 2: Fill form via Streamlit
 st.subheader("Fill Form Online")
+filled_pdf = None  # Filled PDF bytes, only kept for the run that generated them
 with st.form(key="f100d_e_form"):
     st.write("#### NSERC f100d_e Form")
     trainee_name = st.text_input("Trainee Name")
@@ -201,16 +275,9 @@ with st.form(key="f100d_e_form"):
     if submit_button:
         # Map inputs to form fields
         inputs = [trainee_name, name, department, institution, signature_text, date]
-        for input_value, field in zip(inputs, form_fields):
-            st.session_state["f100d_e"][field] = input_value
-        st.write("Form Data:", st.session_state["f100d_e"])
-
-        # Fill form fields
-        fillpdfs.write_fillable_pdf(
-            input_pdf_path=INPUT_PDF,
-            output_pdf_path=OUTPUT_PDF,
-            data_dict=st.session_state["f100d_e"]
-        )
+        form_data = dict(zip(form_fields, inputs))
+        st.session_state["f100d_e"] = form_data
+        st.write("Form Data:", form_data)
 
         # Update form_records.csv
         new_record = {
@@ -218,31 +285,57 @@ with st.form(key="f100d_e_form"):
             "form": "f100d_e",
             "signed_on": date
         }
-        df = fetch_records()
-        # Append new record
-        df = pd.concat([df, pd.DataFrame([new_record])], ignore_index=True)
-        # Save updated CSV
-        record_success = update_repo_file(new_content=df, file_path="assets/form_records.csv", name=name)
-
-        # Post the filled PDF to the repository
         pdf_repo_path = f"assets/filled_forms/f100d_e_{name}_{date}.pdf"
-        pdf_success = post_to_repo(pdf_path=OUTPUT_PDF, file_path=pdf_repo_path, name=name)
-
-        if record_success and pdf_success:
+        now_str = datetime.now().strftime(TIMESTAMP_FORMAT)
+
+        # Recognise a repeated submission of this exact form before touching the network
+        submission_hash = _submission_digest(pdf_repo_path, form_data)
+        is_repeat = st.session_state.get('last_submission_hash') == submission_hash
+
+        # Fetch form_records.csv (content and SHA) while the form is filled; the result feeds the commit.
+        # Worker threads need the script run context to report through st.error.
+        with ThreadPoolExecutor(max_workers=1, initializer=add_script_run_ctx,
+                                initargs=(None, get_script_run_ctx())) as executor:
+            if not is_repeat:
+                records_future = executor.submit(fetch_file, "assets/form_records.csv", missing_ok=True)
+
+            # Fill form fields into an in-memory buffer. fillpdf reads through pdfrw, which accepts
+            # file-like input, so the template comes from the cached blank form bytes instead of disk.
+            pdf_buffer = io.BytesIO()
+            fillpdfs.write_fillable_pdf(
+                input_pdf_path=io.BytesIO(_pdf_bytes(INPUT_PDF, os.path.getmtime(INPUT_PDF))),
+                output_pdf_path=pdf_buffer,
+                data_dict=form_data
+            )
+            filled_pdf = pdf_buffer.getvalue()
+
+        # Commit the new record and the filled PDF together
+        if is_repeat:
+            st.info(f"This form was already submitted to {pdf_repo_path}")
+            submitted = True
+        else:
+            submitted = commit_multi(
+                message=f"Form f100d_e submitted by {name} at {now_str}",
+                updates={
+                    "assets/form_records.csv": lambda existing: _append_csv_row("assets/form_records.csv", existing,
+                                                                                new_record)
+                },
+                creates={pdf_repo_path: filled_pdf},
+                prefetched={"assets/form_records.csv": records_future.result()}
+            )
+            if submitted:
+                st.session_state['last_submission_hash'] = submission_hash
+
+        if submitted:
             st.write("Visit the assets folder in the forms repository if you have access:")
             st.link_button("Visit Records", "https://206-12-100-80.cloud.computecanada.ca/acbc-repo/poduska-lab/KPAdmin")
 
 
 # Download filled PDF outside the form
-if os.path.exists(OUTPUT_PDF):
-    with open(OUTPUT_PDF, "rb") as file:
-        st.download_button(
-            label="Download Filled PDF",
-            data=file,
-            file_name="filled_form.pdf",
-            mime="application/pdf"
-        )
-
-# Clean up temporary files on page refresh (only if they exist)
-if os.path.exists(OUTPUT_PDF):
-    os.remove(OUTPUT_PDF)
\ No newline at end of file
+if filled_pdf is not None:
+    st.download_button(
+        label="Download Filled PDF",
+        data=filled_pdf,
+        file_name="filled_form.pdf",
+        mime="application/pdf"
+    )